@@ -1,13 +1,33 @@
-from flask import Flask, jsonify, request, send_from_directory
+from flask import Flask, jsonify, request, send_from_directory, abort
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.datastructures import MultiDict
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import configure_mappers, scoped_session, selectinload, sessionmaker
+from collections import OrderedDict
 import datetime
+import hashlib
+import json
+import os
+import threading
+import time
 
 app = Flask(__name__)
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///streetwear.db'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SECRET_KEY'] = 'your_secret_key' # Replace with a strong secret key
+app.config['IDEMPOTENCY_KEY_TTL'] = 24 * 60 * 60 # Seconds a stored order response can be replayed
+app.config['IDEMPOTENCY_PURGE_INTERVAL'] = 5 * 60 # Minimum seconds between expired-key purges
+app.config['IDEMPOTENCY_PENDING_TIMEOUT'] = 60 # Seconds an unfinished reservation blocks duplicates before it is abandoned
+app.config['IDEMPOTENCY_CACHE_SIZE'] = 1024 # Max responses held in each worker's front cache
+app.config['IDEMPOTENCY_CACHE_TTL'] = 5 * 60 # Seconds a response stays in the front cache; retries cluster right after the first request
+app.config['WARMUP_CATALOG_LIMIT'] = 200 # Products preloaded by warmup() before serving
+# Optional 'read' bind for catalog and order-history queries, e.g. a replica or a
+# read-only SQLite connection such as 'sqlite:///file:streetwear.db?mode=ro&uri=true'.
+# Added alongside any binds already configured before SQLAlchemy(app) runs.
+if os.environ.get('READ_DATABASE_URI'):
+    app.config.setdefault('SQLALCHEMY_BINDS', {})['read'] = os.environ['READ_DATABASE_URI']
 db = SQLAlchemy(app)
 login_manager = LoginManager(app)
 login_manager.login_view = 'login' # Redirect to login page if user is not authenticated
@@ -19,7 +39,7 @@ class User(UserMixin, db.Model):
     name = db.Column(db.String, nullable=True)
     phone = db.Column(db.String, nullable=True)
     default_address_id = db.Column(db.Integer, db.ForeignKey('address.id'), nullable=True)
-    addresses = db.relationship('Address', backref='user', lazy=True)
+    addresses = db.relationship('Address', backref='user', lazy=True, foreign_keys='Address.user_id')
     orders = db.relationship('Order', backref='user', lazy=True)
     cart_items = db.relationship('CartItem', backref='user', lazy=True)
 
@@ -154,6 +174,152 @@ class NewsletterSubscription(db.Model):
             'email': self.email
         }
 
+class IdempotencyKey(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    key = db.Column(db.String(255), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    request_hash = db.Column(db.String(64), nullable=False) # SHA-256 of the request payload the key was first used with
+    status_code = db.Column(db.Integer, nullable=True) # None while the request holding the key is still in flight
+    response_body = db.Column(db.Text, nullable=True) # JSON-encoded response payload
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow, index=True)
+    __table_args__ = (db.UniqueConstraint('user_id', 'key', name='_user_idempotency_key_uc'),)
+
+# In-memory LRU front cache for finished idempotent responses:
+# (user_id, key) -> (expires_at, request_hash, body, status_code).
+# The IdempotencyKey table stays the source of truth; this only spares replays a database round trip.
+_idempotency_cache = OrderedDict()
+_idempotency_cache_lock = threading.Lock()
+_last_idempotency_purge = None
+
+def _idempotency_ttl():
+    return datetime.timedelta(seconds=app.config['IDEMPOTENCY_KEY_TTL'])
+
+def _idempotency_record_expired(record, now):
+    if record.status_code is None:
+        return record.created_at + datetime.timedelta(seconds=app.config['IDEMPOTENCY_PENDING_TIMEOUT']) <= now
+    return record.created_at + _idempotency_ttl() <= now
+
+def hash_request_payload(data):
+    return hashlib.sha256(json.dumps(data, sort_keys=True).encode('utf-8')).hexdigest()
+
+# Returns (request_hash, body, status_code) for a live key, or None if unknown or expired.
+# body and status_code are None while the request holding the key is still in flight.
+def get_idempotent_response(user_id, key):
+    now = datetime.datetime.utcnow()
+    with _idempotency_cache_lock:
+        cached = _idempotency_cache.get((user_id, key))
+        if cached:
+            if cached[0] > now:
+                _idempotency_cache.move_to_end((user_id, key))
+                return cached[1:]
+            del _idempotency_cache[(user_id, key)]
+
+    record = IdempotencyKey.query.filter_by(user_id=user_id, key=key).first()
+    if not record or _idempotency_record_expired(record, now):
+        return None
+    if record.status_code is None:
+        return record.request_hash, None, None
+
+    body = json.loads(record.response_body)
+    cache_idempotent_response(record, body)
+    return record.request_hash, body, record.status_code
+
+def replay_idempotent_response(user_id, key, request_hash):
+    stored = get_idempotent_response(user_id, key)
+    if not stored:
+        return None
+    stored_hash, body, status_code = stored
+    if stored_hash != request_hash:
+        return jsonify({'message': 'Idempotency-Key was already used with a different request'}), 422
+    if status_code is None:
+        return jsonify({'message': 'A request with this Idempotency-Key is still being processed. Please retry shortly.'}), 409
+    return jsonify(body), status_code
+
+# Claims the key in its own transaction before any cart or stock work, so a retry that
+# overlaps the first request finds the reservation instead of a half-finished checkout.
+# Returns None if another request already holds the key.
+def reserve_idempotency_key(user_id, key, request_hash):
+    now = datetime.datetime.utcnow()
+    existing = IdempotencyKey.query.filter_by(user_id=user_id, key=key).first()
+    if existing and _idempotency_record_expired(existing, now):
+        db.session.delete(existing)
+        db.session.flush() # The unit of work would otherwise insert before deleting
+    record = IdempotencyKey(user_id=user_id, key=key, request_hash=request_hash, created_at=now)
+    db.session.add(record)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return None
+    return record
+
+def release_idempotency_key(record):
+    IdempotencyKey.query.filter_by(id=record.id).delete(synchronize_session=False)
+    db.session.commit()
+
+def cache_idempotent_response(record, body):
+    now = datetime.datetime.utcnow()
+    expires_at = min(now + datetime.timedelta(seconds=app.config['IDEMPOTENCY_CACHE_TTL']),
+                     record.created_at + _idempotency_ttl())
+    cache_key = (record.user_id, record.key)
+    with _idempotency_cache_lock:
+        _idempotency_cache[cache_key] = (expires_at, record.request_hash, body, record.status_code)
+        _idempotency_cache.move_to_end(cache_key)
+        while len(_idempotency_cache) > app.config['IDEMPOTENCY_CACHE_SIZE']:
+            _idempotency_cache.popitem(last=False)
+
+def purge_expired_idempotency_keys():
+    now = datetime.datetime.utcnow()
+    pending_cutoff = now - datetime.timedelta(seconds=app.config['IDEMPOTENCY_PENDING_TIMEOUT'])
+    IdempotencyKey.query.filter(db.or_(
+        IdempotencyKey.created_at <= now - _idempotency_ttl(),
+        db.and_(IdempotencyKey.status_code.is_(None), IdempotencyKey.created_at <= pending_cutoff)
+    )).delete(synchronize_session=False)
+    with _idempotency_cache_lock:
+        expired = [k for k, v in _idempotency_cache.items() if v[0] <= now]
+        for cache_key in expired:
+            del _idempotency_cache[cache_key]
+
+# Runs the purge in its own transaction, at most once per IDEMPOTENCY_PURGE_INTERVAL
+def maybe_purge_expired_idempotency_keys():
+    global _last_idempotency_purge
+    interval = datetime.timedelta(seconds=app.config['IDEMPOTENCY_PURGE_INTERVAL'])
+    if _last_idempotency_purge is not None and datetime.datetime.utcnow() - _last_idempotency_purge < interval:
+        return False
+    try:
+        purge_expired_idempotency_keys()
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        app.logger.exception('Failed to purge expired idempotency keys')
+        return False
+    _last_idempotency_purge = datetime.datetime.utcnow()
+    return True
+
+# Session bound to the 'read' engine, created on first use so checkout writes on the
+# primary engine never hold up catalog reads.
+_read_session = None
+_read_session_lock = threading.Lock()
+
+# Falls back to db.session when no 'read' engine is configured
+def get_read_session():
+    global _read_session
+    read_engine = db.engines.get('read')
+    if read_engine is None:
+        return db.session
+    if _read_session is None or _read_session.session_factory.kw['bind'] is not read_engine:
+        with _read_session_lock:
+            if _read_session is None or _read_session.session_factory.kw['bind'] is not read_engine:
+                if _read_session is not None:
+                    _read_session.remove()
+                _read_session = scoped_session(sessionmaker(bind=read_engine))
+    return _read_session
+
+@app.teardown_appcontext
+def remove_read_session(exception=None):
+    if _read_session is not None:
+        _read_session.remove()
+
 @login_manager.user_loader
 def load_user(user_id):
     return User.query.get(int(user_id))
@@ -277,33 +443,32 @@ def account_password():
     db.session.commit()
     return jsonify({'message': 'Password updated successfully'}), 200
 
-@app.route('/products', methods=['GET'])
-def get_products():
-    query = Product.query.join(ProductVariant) # Join to filter by variant attributes
+def build_products_query(session, args):
+    query = session.query(Product).join(ProductVariant) # Join to filter by variant attributes
 
     # Filtering
-    name = request.args.get('name')
+    name = args.get('name')
     if name:
         query = query.filter(Product.name.ilike(f'%{name}%'))
     
-    min_price = request.args.get('min_price', type=float)
+    min_price = args.get('min_price', type=float)
     if min_price is not None:
         query = query.filter(Product.price >= min_price)
 
-    max_price = request.args.get('max_price', type=float)
+    max_price = args.get('max_price', type=float)
     if max_price is not None:
         query = query.filter(Product.price <= max_price)
 
-    size = request.args.get('size')
+    size = args.get('size')
     if size:
         query = query.filter(ProductVariant.size == size)
 
-    color = request.args.get('color')
+    color = args.get('color')
     if color:
         query = query.filter(ProductVariant.color == color)
 
     # Sorting
-    sort_by = request.args.get('sort_by')
+    sort_by = args.get('sort_by')
     if sort_by:
         if sort_by == 'price_asc':
             query = query.order_by(Product.price.asc())
@@ -315,14 +480,18 @@ def get_products():
             query = query.order_by(Product.name.desc())
     
     # Ensure distinct products if joining with variants caused duplicates
-    query = query.distinct()
+    return query.distinct()
 
-    products = query.all()
+@app.route('/products', methods=['GET'])
+def get_products():
+    products = build_products_query(get_read_session(), request.args).all()
     return jsonify([product.to_dict() for product in products]), 200
 
 @app.route('/products/<int:product_id>', methods=['GET'])
 def get_product(product_id):
-    product = Product.query.get_or_404(product_id)
+    product = get_read_session().get(Product, product_id)
+    if not product:
+        abort(404)
     return jsonify(product.to_dict()), 200
 
 @app.route('/cart', methods=['GET'])
@@ -414,6 +583,38 @@ def remove_from_cart(item_id):
 @app.route('/orders/create', methods=['POST'])
 @login_required
 def create_order():
+    # Clients retrying a slow checkout send the same Idempotency-Key; replay the stored
+    # response instead of touching the cart or stock again.
+    idempotency_key = request.headers.get('Idempotency-Key')
+    if idempotency_key is None:
+        return place_order()
+    if not idempotency_key or len(idempotency_key) > 255:
+        return jsonify({'message': 'Idempotency-Key must be between 1 and 255 characters'}), 400
+
+    request_hash = hash_request_payload(request.get_json(silent=True))
+    replay = replay_idempotent_response(current_user.id, idempotency_key, request_hash)
+    if replay:
+        return replay
+
+    reservation = reserve_idempotency_key(current_user.id, idempotency_key, request_hash)
+    if not reservation:
+        # Another request claimed the key between the lookup and the reservation
+        return (replay_idempotent_response(current_user.id, idempotency_key, request_hash)
+                or (jsonify({'message': 'A request with this Idempotency-Key is still being processed. Please retry shortly.'}), 409))
+
+    response = place_order(reservation)
+    if response[1] == 201:
+        cache_idempotent_response(reservation, response[0].get_json())
+        # Outside the order transaction and throttled, so spikes don't pay for cleanup
+        maybe_purge_expired_idempotency_keys()
+    else:
+        # Failed attempts free the key so the client can correct the request and retry
+        release_idempotency_key(reservation)
+    return response
+
+# Places an order from the current user's cart. When a reservation is given, its response
+# is filled in within the same transaction as the order.
+def place_order(reservation=None):
     data = request.get_json()
     if not data or not data.get('shipping_address_id'):
         return jsonify({'message': 'Shipping address ID is required'}), 400
@@ -442,12 +643,12 @@ def create_order():
                 db.session.rollback() # Not strictly necessary here as no changes made yet, but good practice
                 return jsonify({'message': f'Not enough stock for item {product_variant.product.name} (Variant ID: {product_variant.id})'}), 400
             
-            total_amount += cart_item.quantity * product_variant.price # Assuming ProductVariant has price
+            total_amount += cart_item.quantity * product_variant.product.price # Variants are priced by their product
             # Store details for OrderItem creation
             order_items_to_create.append({
                 'product_variant_id': cart_item.product_variant_id,
                 'quantity': cart_item.quantity,
-                'price_at_purchase': product_variant.price # Store current price
+                'price_at_purchase': product_variant.product.price # Store current price
             })
 
         # Create Order
@@ -482,25 +683,36 @@ def create_order():
 
         # Clear cart
         CartItem.query.filter_by(user_id=current_user.id).delete()
-        
+
+        db.session.flush() # Assign new_order.id before serializing the response
+        order_data = new_order.to_dict()
+        if reservation is not None:
+            reservation.status_code = 201
+            reservation.response_body = json.dumps(order_data)
+
         db.session.commit()
-        return jsonify(new_order.to_dict()), 201
+        return jsonify(order_data), 201
 
     except Exception as e:
         db.session.rollback()
         # Log the exception e
         return jsonify({'message': 'An error occurred while creating the order.'}), 500
 
+def build_user_orders_query(session, user_id):
+    return session.query(Order).filter_by(user_id=user_id).order_by(Order.order_date.desc())
+
 @app.route('/account/orders', methods=['GET'])
 @login_required
 def get_user_orders():
-    orders = Order.query.filter_by(user_id=current_user.id).order_by(Order.order_date.desc()).all()
+    orders = build_user_orders_query(get_read_session(), current_user.id).all()
     return jsonify([order.to_dict() for order in orders]), 200
 
 @app.route('/account/orders/<int:order_id>', methods=['GET'])
 @login_required
 def get_user_order(order_id):
-    order = Order.query.get_or_404(order_id)
+    order = get_read_session().get(Order, order_id)
+    if not order:
+        abort(404)
     if order.user_id != current_user.id:
         return jsonify({'message': 'Order not found or you do not have permission to view it'}), 404 # Or 403
     return jsonify(order.to_dict()), 200
@@ -557,7 +769,69 @@ def serve_create_account_page():
 def serve_my_account_page():
     return send_from_directory('public', 'my_account.html')
 
+# Populated by warmup(); duration_seconds is logged and served at /metrics/warmup.
+# products_preloaded maps each warmed engine ('primary', 'read') to its preloaded count.
+warmup_metrics = {'duration_seconds': None, 'products_preloaded': {}}
+
+# One request shape per sort order and per filter, plus all filters together, so each
+# compiled form of build_products_query is cached. Values are placeholders.
+WARMUP_PRODUCT_QUERY_ARGS = [
+    {},
+    {'sort_by': 'price_asc'},
+    {'sort_by': 'price_desc'},
+    {'sort_by': 'name_asc'},
+    {'sort_by': 'name_desc'},
+    {'name': 'warmup'},
+    {'min_price': '0'},
+    {'max_price': '0'},
+    {'size': 'warmup'},
+    {'color': 'warmup'},
+    {'name': 'warmup', 'min_price': '0', 'max_price': '0', 'size': 'warmup', 'color': 'warmup'},
+]
+
+# Pays cold-start costs before the first request; must run inside an application context
+def warmup():
+    start = time.perf_counter()
+    configure_mappers()
+
+    sessions = {'primary': db.session}
+    if get_read_session() is not db.session:
+        sessions['read'] = get_read_session()
+
+    products_preloaded = {}
+    for engine_name, session in sessions.items():
+        # Run each route's statement shape once so its compiled form is cached per engine
+        for args in WARMUP_PRODUCT_QUERY_ARGS:
+            build_products_query(session, MultiDict(args)).all()
+        session.get(Product, 0)
+        session.get(Order, 0)
+        build_user_orders_query(session, 0).all()
+
+        # Preload the hot catalog so its pages and variants are warm in the page cache
+        products = (session.query(Product)
+                    .options(selectinload(Product.variants))
+                    .order_by(Product.id)
+                    .limit(app.config['WARMUP_CATALOG_LIMIT'])
+                    .all())
+        for product in products:
+            product.to_dict()
+        products_preloaded[engine_name] = len(products)
+        session.rollback()
+
+    warmup_metrics['duration_seconds'] = time.perf_counter() - start
+    warmup_metrics['products_preloaded'] = products_preloaded
+    app.logger.info('Warmup finished in %.3fs (products preloaded: %s)', warmup_metrics['duration_seconds'], products_preloaded)
+    return warmup_metrics['duration_seconds']
+
+@app.route('/metrics/warmup', methods=['GET'])
+def get_warmup_metrics():
+    return jsonify(warmup_metrics), 200
+
 if __name__ == '__main__':
     with app.app_context():
         db.create_all()
+        # debug=True starts a reloader that re-runs this module in a child process with
+        # WERKZEUG_RUN_MAIN set; only that serving process needs warm caches
+        if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+            warmup()
     app.run(debug=True)
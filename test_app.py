@@ -1,6 +1,19 @@
 import unittest
 import json
-from app import app, db, User, Product, ProductVariant, CartItem, Order, OrderItem, Address # Add other models as needed
+import datetime
+import os
+import shutil
+import tempfile
+from sqlalchemy import create_engine
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session
+from werkzeug.security import generate_password_hash
+from app import app, db, User, Product, ProductVariant, CartItem, Order, OrderItem, Address, IdempotencyKey # Add other models as needed
+from unittest import mock
+import app as app_module
+from app import get_idempotent_response, reserve_idempotency_key, cache_idempotent_response, hash_request_payload
+from app import purge_expired_idempotency_keys, maybe_purge_expired_idempotency_keys, _idempotency_cache
+from app import warmup, warmup_metrics, get_read_session
 
 # Configure the Flask app for testing
 app.config['TESTING'] = True
@@ -131,5 +144,275 @@ class TestCart(BaseTestCase):
         self.assertEqual(retrieved_cart_items[0].quantity, 2)
         self.assertEqual(retrieved_cart_items[0].user_id, self.user.id)
 
+class TestIdempotency(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        _idempotency_cache.clear()
+        self.user = User(email='retry@example.com', password_hash='securepassword', name='Retry User')
+        db.session.add(self.user)
+        db.session.commit()
+
+    def add_completed_key(self, key, body, created_at=None):
+        record = IdempotencyKey(user_id=self.user.id, key=key, request_hash='hash-1', status_code=201,
+                                response_body=json.dumps(body), created_at=created_at or datetime.datetime.utcnow())
+        db.session.add(record)
+        db.session.commit()
+        return record
+
+    def test_stored_response_is_replayed(self):
+        self.add_completed_key('checkout-1', {'id': 42, 'status': 'Pending'})
+
+        self.assertEqual(get_idempotent_response(self.user.id, 'checkout-1'), ('hash-1', {'id': 42, 'status': 'Pending'}, 201))
+        # Served from the front cache once the record has been read
+        self.assertIn((self.user.id, 'checkout-1'), _idempotency_cache)
+
+    def test_unknown_key_returns_none(self):
+        self.assertIsNone(get_idempotent_response(self.user.id, 'never-seen'))
+
+    def test_reservation_is_pending_and_exclusive(self):
+        self.assertIsNotNone(reserve_idempotency_key(self.user.id, 'checkout-1', 'hash-1'))
+        self.assertEqual(get_idempotent_response(self.user.id, 'checkout-1'), ('hash-1', None, None))
+        self.assertIsNone(reserve_idempotency_key(self.user.id, 'checkout-1', 'hash-1'))
+
+    def test_abandoned_reservation_can_be_reclaimed(self):
+        record = reserve_idempotency_key(self.user.id, 'checkout-1', 'hash-1')
+        record.created_at = datetime.datetime.utcnow() - datetime.timedelta(seconds=app.config['IDEMPOTENCY_PENDING_TIMEOUT'] + 1)
+        db.session.commit()
+
+        self.assertIsNone(get_idempotent_response(self.user.id, 'checkout-1'))
+        self.assertIsNotNone(reserve_idempotency_key(self.user.id, 'checkout-1', 'hash-2'))
+
+    def test_expired_keys_are_ignored_and_purged(self):
+        self.add_completed_key('old-key', {'id': 1}, created_at=datetime.datetime.utcnow()
+                               - datetime.timedelta(seconds=app.config['IDEMPOTENCY_KEY_TTL'] + 1))
+
+        self.assertIsNone(get_idempotent_response(self.user.id, 'old-key'))
+        purge_expired_idempotency_keys()
+        db.session.commit()
+        self.assertEqual(IdempotencyKey.query.count(), 0)
+
+    def test_front_cache_is_bounded(self):
+        with mock.patch.dict(app.config, {'IDEMPOTENCY_CACHE_SIZE': 2}):
+            for key in ('a', 'b', 'c'):
+                cache_idempotent_response(self.add_completed_key(key, {'key': key}), {'key': key})
+        # The least recently used entry is evicted; the table still has all three
+        self.assertEqual(list(_idempotency_cache), [(self.user.id, 'b'), (self.user.id, 'c')])
+        self.assertEqual(get_idempotent_response(self.user.id, 'a'), ('hash-1', {'key': 'a'}, 201))
+
+    def test_purge_is_throttled(self):
+        with mock.patch('app._last_idempotency_purge', None):
+            self.assertTrue(maybe_purge_expired_idempotency_keys())
+            # A purge just ran, so the next checkout skips it
+            self.assertFalse(maybe_purge_expired_idempotency_keys())
+
+    def test_failed_purge_is_logged_and_retried(self):
+        with mock.patch('app._last_idempotency_purge', None), \
+             mock.patch('app.purge_expired_idempotency_keys', side_effect=RuntimeError('database is locked')), \
+             self.assertLogs(app.logger, level='ERROR'):
+            self.assertFalse(maybe_purge_expired_idempotency_keys())
+            self.assertFalse(maybe_purge_expired_idempotency_keys())
+            # Still unset, so the next checkout tries again
+            self.assertIsNone(app_module._last_idempotency_purge)
+
+class TestIdempotentCheckout(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        _idempotency_cache.clear()
+        self.user = User(email='buyer@example.com', password_hash=generate_password_hash('password123'), name='Buyer')
+        db.session.add(self.user)
+        db.session.flush()
+        self.address = Address(user_id=self.user.id, full_name='Buyer', street_address='1 Main St',
+                               city='Springfield', state='IL', zip_code='62701')
+        self.product = Product(name='Checkout Tee', description='A tee', price=25.00)
+        db.session.add_all([self.address, self.product])
+        db.session.flush()
+        self.variant = ProductVariant(product_id=self.product.id, size='M', color='White', quantity_in_stock=5)
+        db.session.add(self.variant)
+        db.session.flush()
+        db.session.add(CartItem(user_id=self.user.id, product_variant_id=self.variant.id, quantity=2))
+        db.session.commit()
+
+        response = self.client.post('/login', json={'email': 'buyer@example.com', 'password': 'password123'})
+        self.assertEqual(response.status_code, 200)
+
+    def create_order(self, key, shipping_address_id=None):
+        return self.client.post('/orders/create',
+                                json={'shipping_address_id': shipping_address_id or self.address.id},
+                                headers={'Idempotency-Key': key})
+
+    def test_duplicate_submission_replays_order(self):
+        first = self.create_order('checkout-abc')
+        self.assertEqual(first.status_code, 201)
+        self.assertEqual(first.json['total_amount'], 50.00)
+
+        # The cart is empty now; a replay must not fall through to the "empty cart" error
+        second = self.create_order('checkout-abc')
+        self.assertEqual(second.status_code, 201)
+        self.assertEqual(second.json, first.json)
+
+        self.assertEqual(Order.query.count(), 1)
+        self.assertEqual(db.session.get(ProductVariant, self.variant.id).quantity_in_stock, 3)
+
+    def test_replay_from_table_after_cache_is_cleared(self):
+        first = self.create_order('checkout-abc')
+        _idempotency_cache.clear()
+
+        second = self.create_order('checkout-abc')
+        self.assertEqual(second.status_code, 201)
+        self.assertEqual(second.json, first.json)
+        self.assertEqual(Order.query.count(), 1)
+
+    def test_key_reused_with_different_payload_is_rejected(self):
+        self.assertEqual(self.create_order('checkout-abc').status_code, 201)
+
+        response = self.create_order('checkout-abc', shipping_address_id=999)
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(Order.query.count(), 1)
+
+    def test_failed_attempt_releases_key(self):
+        response = self.create_order('checkout-abc', shipping_address_id=999)
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(IdempotencyKey.query.count(), 0)
+
+        self.assertEqual(self.create_order('checkout-abc').status_code, 201)
+
+    def commit_from_other_request(self, status_code=None, body=None):
+        # Another worker's session, committing independently of the request under test
+        with Session(db.engine) as other:
+            other.add(IdempotencyKey(user_id=self.user.id, key='checkout-abc',
+                                     request_hash=hash_request_payload({'shipping_address_id': self.address.id}),
+                                     status_code=status_code,
+                                     response_body=json.dumps(body) if body is not None else None))
+            other.commit()
+
+    def assert_cart_untouched(self):
+        self.assertEqual(Order.query.count(), 0)
+        self.assertEqual(CartItem.query.filter_by(user_id=self.user.id).count(), 1)
+        self.assertEqual(db.session.get(ProductVariant, self.variant.id).quantity_in_stock, 5)
+
+    def test_retry_during_in_flight_request_is_told_to_wait(self):
+        self.commit_from_other_request()
+
+        response = self.create_order('checkout-abc')
+        self.assertEqual(response.status_code, 409)
+        self.assert_cart_untouched()
+
+        # Once the first request finishes, the retry gets its order
+        stored = IdempotencyKey.query.filter_by(key='checkout-abc').one()
+        stored.status_code = 201
+        stored.response_body = json.dumps({'id': 7, 'status': 'Pending'})
+        db.session.commit()
+
+        response = self.create_order('checkout-abc')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json, {'id': 7, 'status': 'Pending'})
+
+    def test_key_claimed_between_lookup_and_reservation_replays(self):
+        real_lookup = get_idempotent_response
+        calls = []
+
+        def racing_lookup(user_id, key):
+            if not calls:
+                calls.append(key)
+                # The first request commits right after this lookup misses
+                self.commit_from_other_request(201, {'id': 7, 'status': 'Pending'})
+                return None
+            return real_lookup(user_id, key)
+
+        with mock.patch('app.get_idempotent_response', side_effect=racing_lookup):
+            response = self.create_order('checkout-abc')
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json, {'id': 7, 'status': 'Pending'})
+        self.assert_cart_untouched()
+
+class TestWarmup(BaseTestCase):
+    def test_warmup_records_duration(self):
+        product = Product(name='Warm Hoodie', description='A warm hoodie', price=80.00)
+        db.session.add(product)
+        db.session.commit()
+
+        duration = warmup()
+        self.assertGreaterEqual(duration, 0)
+        self.assertEqual(warmup_metrics['duration_seconds'], duration)
+        self.assertEqual(warmup_metrics['products_preloaded'], {'primary': 1})
+
+        response = self.client.get('/metrics/warmup')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json['products_preloaded'], {'primary': 1})
+
+    def test_read_session_defaults_to_primary(self):
+        # Without a 'read' bind configured, reads share the primary session
+        self.assertIs(get_read_session(), db.session)
+
+class TestReadRouting(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User(email='reader@example.com', password_hash=generate_password_hash('password123'), name='Reader')
+        db.session.add(self.user)
+        db.session.commit()
+
+        # Seed a second SQLite file that only the 'read' engine can see
+        self.read_dir = tempfile.mkdtemp()
+        read_path = os.path.join(self.read_dir, 'read_replica.db')
+        seed_engine = create_engine(f'sqlite:///{read_path}')
+        db.metadata.create_all(seed_engine)
+        with Session(seed_engine) as session:
+            product = Product(name='Replica Jacket', description='Only on the replica', price=120.00)
+            session.add(product)
+            session.flush()
+            session.add(ProductVariant(product_id=product.id, size='L', color='Green', quantity_in_stock=3))
+            address = Address(user_id=self.user.id, full_name='Reader', street_address='2 Side St',
+                              city='Springfield', state='IL', zip_code='62701')
+            session.add(address)
+            session.flush()
+            session.add(Order(user_id=self.user.id, shipping_address_id=address.id, total_amount=120.00))
+            session.commit()
+        seed_engine.dispose()
+
+        self.read_engine = create_engine(f'sqlite:///file:{read_path}?mode=ro&uri=true')
+        db.engines['read'] = self.read_engine
+
+        response = self.client.post('/login', json={'email': 'reader@example.com', 'password': 'password123'})
+        self.assertEqual(response.status_code, 200)
+
+    def tearDown(self):
+        get_read_session().remove()
+        db.engines.pop('read', None)
+        self.read_engine.dispose()
+        shutil.rmtree(self.read_dir)
+        super().tearDown()
+
+    def test_read_session_uses_read_engine(self):
+        self.assertIs(get_read_session().get_bind(), db.engines['read'])
+
+    def test_catalog_served_from_read_engine(self):
+        response = self.client.get('/products')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([p['name'] for p in response.json], ['Replica Jacket'])
+        self.assertEqual(Product.query.count(), 0) # Primary database has no products
+
+        response = self.client.get(f"/products/{response.json[0]['id']}")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json['name'], 'Replica Jacket')
+
+    def test_order_history_served_from_read_engine(self):
+        response = self.client.get('/account/orders')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json), 1)
+        self.assertEqual(response.json[0]['total_amount'], 120.00)
+        self.assertEqual(Order.query.count(), 0)
+
+    def test_read_engine_rejects_writes(self):
+        session = get_read_session()
+        session.add(Product(name='Should Fail', description='Read-only', price=1.00))
+        with self.assertRaises(OperationalError):
+            session.commit()
+        session.rollback()
+
+    def test_warmup_covers_read_engine(self):
+        warmup()
+        self.assertEqual(warmup_metrics['products_preloaded'], {'primary': 0, 'read': 1})
+
 if __name__ == '__main__':
     unittest.main()